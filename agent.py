@@ -7,7 +7,7 @@ except Exception:
 
 # Importaciones de LangGraph y LangChain
 from langgraph.graph.message import add_messages
-from typing import List, Any, Dict, Annotated, Optional, Literal
+from typing import List, Any, Dict, Annotated, Optional, Literal, Tuple, AsyncIterator
 import uuid
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
@@ -16,12 +16,13 @@ from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, Base
 from langgraph.graph import StateGraph, START, END
 from langgraph.prebuilt import ToolNode
 import asyncio
+import time
 from pydantic import BaseModel, Field
 
 # --- IMPORTACIÓN DE HERRAMIENTAS ---
 
 try:
-    from flightassistant_tools import ryanair_flight_search, send_email
+    from flightassistant_tools import ryanair_flight_search, send_email, city_to_iata
 except ImportError:
     pass
 
@@ -45,96 +46,183 @@ class EvaluatorOutput(BaseModel):
     success_criteria_met: bool = Field(description="True si se han cumplido los criterios de éxito")
     user_input_needed: bool = Field(description="True si se necesita más información del usuario o el asistente está atascado")
 
+# Número de mensajes (usuario/asistente) recientes que ve el evaluador
+EVALUATOR_HISTORY_WINDOW = 6
+
+# Atajo para saltarse el evaluador en turnos triviales ("gracias", "¿qué día es hoy?").
+# Si el usuario pide una tarea (vuelos, emails...) siempre pasamos por el evaluador.
+EVALUATOR_MIN_CONTENT_LENGTH = 30
+EVALUATOR_TASK_KEYWORDS = (
+    "book", "search", "flight", "mail",
+    "reserva", "busca", "vuelo", "correo",
+)
+
+# --- PROMPTS ESTÁTICOS ---
+# OpenAI cachea automáticamente el prefijo común de los prompts (a partir de 1024 tokens).
+# Por eso el bloque fijo va primero y se construye una sola vez; fecha, criterios y
+# feedback se añaden siempre al final.
+_STATIC_WORKER_PROMPT = """You are a helpful assistant equipped with web tools and FLIGHT search tools, and EMAIL tools.
+You keep working on a task until either you have a question or clarification for the user, or the success criteria is met.
+
+### CRITICAL ERROR HANDLING (HIGHEST PRIORITY):
+If the 'ryanair_flight_search' tool returns a message mentioning "Cold Start", "reiniciando", or "502":
+1. DO NOT CALL THE TOOL AGAIN immediately.
+2. STOP and inform the user: "⚠️ El servidor de vuelos se está iniciando (Cold Start). Por favor, espera 30 segundos y vuelve a preguntarme."
+3. Do not try to fix it yourself, just report it and stop.
+
+### RULES FOR FLIGHT SEARCH:
+1. If the user asks for flights, use the 'ryanair_flight_search' tool.
+2. You can pass city names directly; the tool converts them and validates dates.
+
+### RULES FOR EMAIL:
+1. OFFER EMAIL: After presenting the results, YOU MUST ASK the user: "Do you want me to email you this summary?".
+2. SEND EMAIL:
+   - If the user says YES: Ask for their email address (if you don't know it yet).
+   - Once you have the email, use 'send_email' tool to send the summary.
+   - Subject should be descriptive (e.g., "Flight Summary: MAD to LON").
+"""
+
+_EVALUATOR_SYSTEM_PROMPT = """You are an evaluator. Assess if the Assistant met the success criteria.
+You will receive the success criteria, the conversation and the last assistant response.
+Answer whether the assistant met the criteria and whether it needs more user input."""
+
+# Mensajes de sistema creados una sola vez. El del worker se copia con model_copy()
+# añadiendo la parte dinámica (más barato que validar un mensaje nuevo con Pydantic).
+_STATIC_WORKER_MESSAGE = SystemMessage(content=_STATIC_WORKER_PROMPT)
+_EVALUATOR_SYSTEM_MESSAGE = SystemMessage(content=_EVALUATOR_SYSTEM_PROMPT)
+
+# Fecha para el prompt con resolución de una hora: con segundos el texto cambiaba en
+# cada llamada y rompía la caché de prompts de OpenAI. (bucket horario, texto)
+_date_cache: Tuple[int, str] = (-1, "")
+
+
+def _current_date_string() -> str:
+    """Fecha y hora actual ("YYYY-MM-DD HH:00"), recalculada solo al cambiar de hora."""
+    global _date_cache
+    bucket = int(time.time() // 3600)
+    if bucket != _date_cache[0]:
+        _date_cache = (bucket, datetime.now().strftime("%Y-%m-%d %H:00"))
+    return _date_cache[1]
+
+# --- MODELOS (UNO POR PROCESO) ---
+# bind_tools / with_structured_output construyen pipelines Runnable nuevos cada vez:
+# los creamos una sola vez y los compartimos entre todas las instancias del asistente.
+_worker_llm = None
+# Worker con herramientas por combinación de herramientas (nombres), por si una
+# instancia usa una lista distinta
+_worker_llms_with_tools: Dict[Tuple[str, ...], Any] = {}
+_evaluator_llm_with_output = None
+WORKER_LLM_TAG = "worker_llm"
+
+
+def _get_llms(tools):
+    """Devuelve (worker con herramientas, evaluador estructurado), creándolos la primera vez."""
+    global _worker_llm, _evaluator_llm_with_output
+    if _worker_llm is None:
+        # Configurar el modelo del Worker (el que hace el trabajo)
+        _worker_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    key = tuple(t.name for t in tools)
+    if key not in _worker_llms_with_tools:
+        # La etiqueta permite distinguir sus tokens en stream_superstep
+        _worker_llms_with_tools[key] = _worker_llm.bind_tools(tools).with_config(tags=[WORKER_LLM_TAG])
+    if _evaluator_llm_with_output is None:
+        # Configurar el modelo del Evaluador (el que critica el trabajo)
+        evaluator_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        _evaluator_llm_with_output = evaluator_llm.with_structured_output(EvaluatorOutput)
+    return _worker_llms_with_tools[key], _evaluator_llm_with_output
+
 # --- CLASE PRINCIPAL DEL ASISTENTE ---
 class FlightAssistant:
     def __init__(self, memory):
         self.worker_llm_with_tools = None
         self.evaluator_llm_with_output = None
-        self.tools = [ryanair_flight_search, send_email]
+        self.tools = [ryanair_flight_search, send_email, city_to_iata]
         self.memory = memory # Checkpointer para persistencia (SQLite)
         self.graph = None
         
 
     async def setup(self):
-        """Inicializa los modelos y construye el grafo."""
-        
-        # Configurar el modelo del Worker (el que hace el trabajo)
-        worker_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-        self.worker_llm_with_tools = worker_llm.bind_tools(self.tools)
+        """Inicializa los modelos y construye el grafo (solo la primera vez)."""
+        if self.graph is not None:
+            return
 
-        # Configurar el modelo del Evaluador (el que critica el trabajo)
-        evaluator_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-        self.evaluator_llm_with_output = evaluator_llm.with_structured_output(EvaluatorOutput)
+        self.worker_llm_with_tools, self.evaluator_llm_with_output = _get_llms(self.tools)
         
         # Construir el grafo
         await self.build_graph()
 
+    async def warmup(self):
+        """Abre la conexión TLS con OpenAI antes del primer mensaje (sin gastar tokens)."""
+        if _worker_llm is None:
+            return
+        try:
+            # Todos los ChatOpenAI comparten el pool httpx del SDK, así que basta con una petición
+            await _worker_llm.root_async_client.models.retrieve(_worker_llm.model_name)
+        except Exception as e:
+            print(f"⚠️ No se pudo precalentar la conexión con OpenAI: {e}")
+
     # --- NODOS DEL GRAFO ---
 
-    def worker(self, state: State) -> Dict[str, Any]:
+    async def worker(self, state: State) -> Dict[str, Any]:
         """
         Nodo Worker: Genera respuestas o llamadas a herramientas.
         """
-        # Instrucciones del sistema dinámicas
-        system_message_content = f"""You are a helpful assistant equipped with web tools and FLIGHT search tools, and EMAIL tools.
-            You keep working on a task until either you have a question or clarification for the user, or the success criteria is met.
-            The current date is {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}.
-            
-            This is the success criteria:
-            {state.get("success_criteria", "Provide a helpful answer")}
-
-            ### CRITICAL ERROR HANDLING (HIGHEST PRIORITY):
-            If the 'ryanair_flight_search' tool returns a message mentioning "Cold Start", "reiniciando", or "502":
-            1. DO NOT CALL THE TOOL AGAIN immediately.
-            2. STOP and inform the user: "⚠️ El servidor de vuelos se está iniciando (Cold Start). Por favor, espera 30 segundos y vuelve a preguntarme."
-            3. Do not try to fix it yourself, just report it and stop.
-
-            ### RULES FOR FLIGHT SEARCH:
-            1. If the user asks for flights, use the 'ryanair_flight_search' tool.
-            2. You MUST convert city names to IATA codes yourself (e.g., Madrid -> MAD).
-            3. Format dates strictly as YYYY-MM-DD.
-            
-            ### RULES FOR EMAIL:
-            1. OFFER EMAIL: After presenting the results, YOU MUST ASK the user: "Do you want me to email you this summary?".
-            2. SEND EMAIL: 
-               - If the user says YES: Ask for their email address (if you don't know it yet).
-               - Once you have the email, use 'send_email' tool to send the summary.
-               - Subject should be descriptive (e.g., "Flight Summary: MAD to LON").
-        """
-        
-        # Si hubo feedback negativo anterior, lo añadimos al prompt
+        # Prompt estático primero (cacheable por OpenAI) y la parte dinámica al final
+        # Orden de más estable a menos: criterios (fijos), fecha (cambia cada hora), feedback
+        dynamic_content = f"""
+### CONTEXT:
+This is the success criteria:
+{state.get("success_criteria") or "Provide a helpful answer"}
+The current date is {_current_date_string()}.
+"""
+
+        # Si hubo feedback negativo anterior, lo añadimos al final del prompt
         if state.get("feedback_on_work"):
-            system_message_content += f"""
-            Previously your reply was rejected. Feedback: {state["feedback_on_work"]}
-            Please fix this.
-            """
-        
+            dynamic_content += f"""
+Previously your reply was rejected. Feedback: {state["feedback_on_work"]}
+Please fix this.
+"""
+
         # Gestión de mensajes: Insertamos el SystemMessage al principio
-        messages = state["messages"]
-        # Filtramos mensajes de sistema antiguos para no acumularlos si el bucle se repite mucho
-        filtered_messages = [m for m in messages if not isinstance(m, SystemMessage)]
-        final_messages = [SystemMessage(content=system_message_content)] + filtered_messages
-        
-        response = self.worker_llm_with_tools.invoke(final_messages)
-        
+        # El SystemMessage nunca se guarda en el estado (solo devolvemos la respuesta),
+        # así que no hace falta filtrar mensajes de sistema antiguos en cada vuelta.
+        system_message = _STATIC_WORKER_MESSAGE.model_copy(
+            update={"content": _STATIC_WORKER_PROMPT + dynamic_content}
+        )
+        final_messages = [system_message, *state["messages"]]
+
+        response = await self.worker_llm_with_tools.ainvoke(final_messages)
+
         # Devolvemos el nuevo mensaje para que se añada al estado
         return {"messages": [response]}
     
     def format_conversation(self, messages: List[BaseMessage]) -> str:
         """Helper para formatear el chat como texto plano para el evaluador."""
+        # Solo los últimos mensajes de usuario/asistente: el evaluador juzga la última
+        # respuesta y así su coste no crece con la longitud de la conversación.
+        window = []
+        for message in reversed(messages):
+            # Las llamadas a herramientas sin texto no cuentan: si el worker hace varias
+            # búsquedas, la pregunta del usuario no debe quedarse fuera de la ventana
+            if isinstance(message, AIMessage) and message.tool_calls and not message.content:
+                continue
+            if isinstance(message, (HumanMessage, AIMessage)):
+                window.append(message)
+                if len(window) == EVALUATOR_HISTORY_WINDOW:
+                    break
+            # Omitimos system/tool messages para el evaluador para no confundirlo
+
         conversation = "Conversation history:\n\n"
-        for message in messages:
+        for message in reversed(window):
             if isinstance(message, HumanMessage):
                 conversation += f"User: {message.content}\n"
-            elif isinstance(message, AIMessage):
+            else:
                 # Manejo seguro si content es None (p.ej. solo tool_call)
                 text = message.content if message.content else "[Tool Call]"
                 conversation += f"Assistant: {text}\n"
-            elif isinstance(message, SystemMessage):
-                continue # Omitimos system messages para el evaluador para no confundirlo
         return conversation
     
-    def evaluator(self, state: State) -> Dict[str, Any]:
+    async def evaluator(self, state: State) -> Dict[str, Any]:
         """
         Nodo Evaluador: Juzga la última respuesta del Worker.
         """
@@ -142,24 +230,22 @@ class FlightAssistant:
         last_message = state["messages"][-1]
         last_response = last_message.content if last_message.content else "[Action/Tool Call]"
 
-        system_prompt = """You are an evaluator. Assess if the Assistant met the success criteria."""
-        
-        user_prompt = f"""
-        Conversation:
-        {self.format_conversation(state["messages"])}
+        # Lo estable (criterios) va delante; conversación y última respuesta al final
+        user_prompt = f"""Success Criteria:
+{state.get("success_criteria")}
 
-        Success Criteria:
-        {state.get("success_criteria")}
+Conversation:
+{self.format_conversation(state["messages"])}
 
-        Last Assistant Response:
-        {last_response}
+Last Assistant Response:
+{last_response}
 
-        Did the assistant meet the criteria? Does it need more user input?
-        """
+Did the assistant meet the criteria? Does it need more user input?
+"""
 
         # Invocamos al LLM con salida estructurada
-        eval_result = self.evaluator_llm_with_output.invoke([
-            SystemMessage(content=system_prompt),
+        eval_result = await self.evaluator_llm_with_output.ainvoke([
+            _EVALUATOR_SYSTEM_MESSAGE,
             HumanMessage(content=user_prompt)
         ])
 
@@ -174,11 +260,28 @@ class FlightAssistant:
 
     # --- FUNCIONES DE ENRUTAMIENTO (EDGES) ---
 
-    def worker_router(self, state: State) -> Literal["tools", "evaluator"]:
-        """Decide si el worker quiere usar una herramienta o si ha terminado de hablar."""
+    def needs_evaluation(self, state: State) -> bool:
+        """True si la respuesta final del worker debe pasar por el evaluador."""
+        response = state["messages"][-1]
+        if response.tool_calls:
+            return False
+        content = response.content if isinstance(response.content, str) else ""
+        if len(content.strip()) <= EVALUATOR_MIN_CONTENT_LENGTH:
+            return True
+        # Buscamos el último mensaje del usuario
+        for message in reversed(state["messages"]):
+            if isinstance(message, HumanMessage):
+                user_text = str(message.content).lower()
+                return any(keyword in user_text for keyword in EVALUATOR_TASK_KEYWORDS)
+        return True
+
+    def worker_router(self, state: State) -> Literal["tools", "evaluator", "END"]:
+        """Decide si el worker quiere usar una herramienta, necesita evaluación o ha terminado."""
         last_message = state["messages"][-1]
         if isinstance(last_message, AIMessage) and last_message.tool_calls:
             return "tools"
+        if isinstance(last_message, AIMessage) and not self.needs_evaluation(state):
+            return "END" # Respuesta trivial: no merece otra llamada al LLM
         return "evaluator"
     
     def route_based_on_evaluation(self, state: State) -> Literal["END", "worker"]:
@@ -201,11 +304,11 @@ class FlightAssistant:
         # Añadir Aristas (Flujo)
         graph_builder.add_edge(START, "worker")
         
-        # Salida del Worker: ¿Herramientas o Evaluación?
+        # Salida del Worker: ¿Herramientas, Evaluación o Fin (respuesta trivial)?
         graph_builder.add_conditional_edges(
             "worker", 
             self.worker_router, 
-            {"tools": "tools", "evaluator": "evaluator"}
+            {"tools": "tools", "evaluator": "evaluator", "END": END}
         )
         
         # Salida de Herramientas: Siempre vuelve al worker
@@ -222,13 +325,9 @@ class FlightAssistant:
         # Compilación con memoria
         self.graph = graph_builder.compile(checkpointer=self.memory)
     
-    async def run_superstep(self, user_input: str, thread_id: str):
-        """
-        Ejecuta un paso.
-        """
-        config = {"configurable": {"thread_id": thread_id}} # Usamos el ID que viene de la API
-
-        initial_input = {
+    def _initial_input(self, user_input: str) -> Dict[str, Any]:
+        """Estado inicial de un turno a partir del mensaje del usuario."""
+        return {
             "messages": [HumanMessage(content=user_input)],
             "success_criteria": "Answer clearly. Offer email if relevant.",
             "success_criteria_met": False,
@@ -236,6 +335,14 @@ class FlightAssistant:
             "feedback_on_work": None
         }
 
+    async def run_superstep(self, user_input: str, thread_id: str):
+        """
+        Ejecuta un paso.
+        """
+        config = {"configurable": {"thread_id": thread_id}} # Usamos el ID que viene de la API
+
+        initial_input = self._initial_input(user_input)
+
         # Invocamos el grafo
         # Usamos invoke o ainvoke. Esto ejecutará el bucle worker -> evaluator -> worker hasta que termine.
         final_state = await self.graph.ainvoke(initial_input, config=config)
@@ -247,3 +354,25 @@ class FlightAssistant:
         
         return last_msg.content
 
+    async def stream_superstep(self, user_input: str, thread_id: str) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Igual que run_superstep pero va devolviendo eventos (tipo, datos) según se generan:
+        - ("reset", None): empieza una nueva llamada del worker, descartar el texto parcial.
+        - ("token", str): trozo de texto del worker.
+        - ("done", str): respuesta final del turno.
+        """
+        config = {"configurable": {"thread_id": thread_id}}
+
+        async for event in self.graph.astream_events(self._initial_input(user_input), config=config, version="v2"):
+            # Solo nos interesan las llamadas al LLM del worker (no las del evaluador)
+            if WORKER_LLM_TAG not in event.get("tags", []):
+                continue
+            if event["event"] == "on_chat_model_start":
+                yield "reset", None
+            elif event["event"] == "on_chat_model_stream":
+                content = event["data"]["chunk"].content
+                if content:
+                    yield "token", content
+
+        final_state = await self.graph.aget_state(config)
+        yield "done", final_state.values["messages"][-1].content
@@ -2,20 +2,276 @@ from langchain.tools import tool
 import smtplib
 from email.mime.text import MIMEText
 import os
+import re
+import sys
+import time
+import unicodedata
+from datetime import datetime
+from types import MappingProxyType
+import asyncio
+import threading
+from collections import OrderedDict
 import httpx
+import orjson
+
+# --- CLIENTE HTTP COMPARTIDO ---
+# Un único AsyncClient para todo el proceso: reutiliza conexiones keep-alive y nos
+# ahorramos el handshake TCP+TLS con Render en cada búsqueda.
+# Los tools de LangChain no admiten inyección de dependencias, así que es un singleton
+# que se crea la primera vez que se pide (o en el lifespan de la app).
+FLIGHT_API_BASE_URL = "https://ryanair-api-hx0t.onrender.com/"
+
+_http_client: "httpx.AsyncClient | None" = None
+_http_client_lock = asyncio.Lock()
+
+
+async def get_http_client() -> httpx.AsyncClient:
+    """Devuelve el cliente HTTP compartido, creándolo si aún no existe."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        async with _http_client_lock:
+            if _http_client is None or _http_client.is_closed:
+                # Timeout de 120 segundos porque la API de Render es lenta al despertar
+                _http_client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(120.0, connect=10.0),
+                    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+                )
+    return _http_client
+
+
+async def warmup_http_client() -> None:
+    """Abre la conexión (DNS + TLS) con la API de vuelos antes de la primera búsqueda."""
+    client = await get_http_client()
+    try:
+        await client.head(FLIGHT_API_BASE_URL)
+    except Exception as e:
+        print(f"⚠️ No se pudo precalentar la API de vuelos: {e}")
+
+
+async def close_http_client() -> None:
+    """Cierra el cliente HTTP compartido (se llama al apagar el servidor)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# --- VALIDACIÓN DE AEROPUERTOS Y FECHAS ---
+# Convertir ciudades a IATA y revisar fechas es determinista: lo hacemos en Python
+# en vez de gastar tokens del LLM. Ciudad (en español y/o inglés) -> aeropuerto principal
+# (el que usa Ryanair cuando la ciudad tiene varios).
+_RAW_CITY_TO_IATA = {
+    # España
+    "A Coruña": "LCG", "Alicante": "ALC", "Almería": "LEI", "Asturias": "OVD", "Oviedo": "OVD",
+    "Badajoz": "BJZ", "Barcelona": "BCN", "Bilbao": "BIO", "Burgos": "RGS", "Castellón": "CDT",
+    "Córdoba": "ODB", "Fuerteventura": "FUE", "Girona": "GRO", "Gran Canaria": "LPA",
+    "Las Palmas": "LPA", "Granada": "GRX", "Ibiza": "IBZ", "Jerez": "XRY", "La Palma": "SPC",
+    "Lanzarote": "ACE", "León": "LEN", "Logroño": "RJL", "Madrid": "MAD", "Málaga": "AGP",
+    "Melilla": "MLN", "Menorca": "MAH", "Mahón": "MAH", "Murcia": "RMU", "Palma": "PMI",
+    "Palma de Mallorca": "PMI", "Mallorca": "PMI", "Pamplona": "PNA", "Reus": "REU",
+    "Salamanca": "SLM", "San Sebastián": "EAS", "Santander": "SDR",
+    "Santiago de Compostela": "SCQ", "Sevilla": "SVQ", "Seville": "SVQ", "Tenerife": "TFS",
+    "Tenerife Sur": "TFS", "Tenerife Norte": "TFN", "Valencia": "VLC", "Valladolid": "VLL",
+    "Vigo": "VGO", "Vitoria": "VIT", "Zaragoza": "ZAZ",
+    # Portugal
+    "Lisboa": "LIS", "Lisbon": "LIS", "Oporto": "OPO", "Porto": "OPO", "Faro": "FAO",
+    "Funchal": "FNC", "Madeira": "FNC", "Ponta Delgada": "PDL",
+    # Reino Unido e Irlanda
+    "Londres": "STN", "London": "STN", "Manchester": "MAN", "Liverpool": "LPL",
+    "Birmingham": "BHX", "Bristol": "BRS", "Edimburgo": "EDI", "Edinburgh": "EDI",
+    "Glasgow": "GLA", "Leeds": "LBA", "Newcastle": "NCL", "East Midlands": "EMA",
+    "Nottingham": "EMA", "Belfast": "BFS", "Aberdeen": "ABZ", "Cardiff": "CWL",
+    "Exeter": "EXT", "Bournemouth": "BOH", "Southampton": "SOU",
+    "Dublín": "DUB", "Dublin": "DUB", "Cork": "ORK", "Shannon": "SNN", "Knock": "NOC",
+    "Kerry": "KIR",
+    # Francia
+    "París": "BVA", "Paris": "BVA", "Beauvais": "BVA", "Marsella": "MRS", "Marseille": "MRS",
+    "Niza": "NCE", "Nice": "NCE", "Lyon": "LYS", "Toulouse": "TLS", "Burdeos": "BOD",
+    "Bordeaux": "BOD", "Nantes": "NTE", "Montpellier": "MPL", "Lille": "LIL",
+    "Estrasburgo": "SXB", "Strasbourg": "SXB", "Biarritz": "BIQ", "Carcassonne": "CCF",
+    "Perpiñán": "PGF", "Perpignan": "PGF", "Nîmes": "FNI", "Bergerac": "EGC",
+    "La Rochelle": "LRH", "Limoges": "LIG", "Poitiers": "PIS", "Brest": "BES", "Tours": "TUF",
+    "Béziers": "BZR", "Ajaccio": "AJA", "Bastia": "BIA",
+    # Italia
+    "Roma": "FCO", "Rome": "FCO", "Milán": "BGY", "Milan": "BGY", "Bergamo": "BGY",
+    "Venecia": "VCE", "Venice": "VCE", "Treviso": "TSF", "Nápoles": "NAP", "Naples": "NAP",
+    "Bolonia": "BLQ", "Bologna": "BLQ", "Pisa": "PSA", "Florencia": "FLR", "Florence": "FLR",
+    "Turín": "TRN", "Turin": "TRN", "Bari": "BRI", "Brindisi": "BDS", "Palermo": "PMO",
+    "Catania": "CTA", "Cagliari": "CAG", "Alghero": "AHO", "Olbia": "OLB", "Trapani": "TPS",
+    "Comiso": "CIY", "Lamezia Terme": "SUF", "Pescara": "PSR", "Ancona": "AOI",
+    "Génova": "GOA", "Genoa": "GOA", "Verona": "VRN", "Trieste": "TRS", "Perugia": "PEG",
+    "Rimini": "RMI", "Cuneo": "CUF", "Parma": "PMF",
+    # Alemania
+    "Berlín": "BER", "Berlin": "BER", "Múnich": "MUC", "Munich": "MUC", "Fráncfort": "FRA",
+    "Frankfurt": "FRA", "Hamburgo": "HAM", "Hamburg": "HAM", "Colonia": "CGN",
+    "Cologne": "CGN", "Düsseldorf": "DUS", "Stuttgart": "STR", "Núremberg": "NUE",
+    "Nuremberg": "NUE", "Bremen": "BRE", "Hannover": "HAJ", "Hanover": "HAJ",
+    "Leipzig": "LEJ", "Dresde": "DRS", "Dresden": "DRS", "Dortmund": "DTM",
+    "Memmingen": "FMM", "Weeze": "NRN", "Karlsruhe": "FKB", "Baden-Baden": "FKB",
+    "Hahn": "HHN", "Münster": "FMO", "Paderborn": "PAD",
+    # Benelux, Suiza y Austria
+    "Ámsterdam": "AMS", "Amsterdam": "AMS", "Eindhoven": "EIN", "Rotterdam": "RTM",
+    "Maastricht": "MST", "Bruselas": "CRL", "Brussels": "CRL", "Charleroi": "CRL",
+    "Luxemburgo": "LUX", "Luxembourg": "LUX", "Zúrich": "ZRH", "Zurich": "ZRH",
+    "Ginebra": "GVA", "Geneva": "GVA", "Basilea": "BSL", "Basel": "BSL", "Viena": "VIE",
+    "Vienna": "VIE", "Salzburgo": "SZG", "Salzburg": "SZG", "Linz": "LNZ",
+    "Innsbruck": "INN", "Graz": "GRZ",
+    # Países nórdicos y bálticos
+    "Copenhague": "CPH", "Copenhagen": "CPH", "Billund": "BLL", "Aarhus": "AAR",
+    "Estocolmo": "ARN", "Stockholm": "ARN", "Gotemburgo": "GOT", "Gothenburg": "GOT",
+    "Malmö": "MMX", "Oslo": "OSL", "Bergen": "BGO", "Helsinki": "HEL", "Tampere": "TMP",
+    "Reikiavik": "KEF", "Reykjavik": "KEF", "Riga": "RIX", "Vilna": "VNO", "Vilnius": "VNO",
+    "Kaunas": "KUN", "Tallin": "TLL", "Tallinn": "TLL",
+    # Europa central y del este
+    "Varsovia": "WMI", "Warsaw": "WMI", "Cracovia": "KRK", "Kraków": "KRK", "Krakow": "KRK",
+    "Gdansk": "GDN", "Gdańsk": "GDN", "Breslavia": "WRO", "Wrocław": "WRO", "Wroclaw": "WRO",
+    "Poznań": "POZ", "Poznan": "POZ", "Katowice": "KTW", "Łódź": "LCJ", "Lodz": "LCJ",
+    "Rzeszów": "RZE", "Rzeszow": "RZE", "Szczecin": "SZZ", "Lublin": "LUZ",
+    "Bydgoszcz": "BZG", "Praga": "PRG", "Prague": "PRG", "Brno": "BRQ", "Ostrava": "OSR",
+    "Bratislava": "BTS", "Budapest": "BUD", "Debrecen": "DEB", "Bucarest": "OTP",
+    "Bucharest": "OTP", "Cluj-Napoca": "CLJ", "Cluj": "CLJ", "Timisoara": "TSR",
+    "Iasi": "IAS", "Sofía": "SOF", "Sofia": "SOF", "Plovdiv": "PDV", "Varna": "VAR",
+    "Burgas": "BOJ", "Zagreb": "ZAG", "Split": "SPU", "Dubrovnik": "DBV", "Zadar": "ZAD",
+    "Pula": "PUY", "Rijeka": "RJK", "Liubliana": "LJU", "Ljubljana": "LJU",
+    "Belgrado": "BEG", "Belgrade": "BEG", "Podgorica": "TGD", "Sarajevo": "SJJ",
+    "Skopie": "SKP", "Skopje": "SKP", "Tirana": "TIA",
+    # Grecia, Chipre, Malta y Turquía
+    "Atenas": "ATH", "Athens": "ATH", "Tesalónica": "SKG", "Thessaloniki": "SKG",
+    "Corfú": "CFU", "Corfu": "CFU", "Rodas": "RHO", "Rhodes": "RHO", "Heraklion": "HER",
+    "Creta": "HER", "Crete": "HER", "Chania": "CHQ", "Kos": "KGS", "Santorini": "JTR",
+    "Mykonos": "JMK", "Zakynthos": "ZTH", "Zante": "ZTH", "Kefalonia": "EFL", "Malta": "MLA",
+    "Pafos": "PFO", "Paphos": "PFO", "Larnaca": "LCA", "Estambul": "IST", "Istanbul": "IST",
+    "Antalya": "AYT", "Esmirna": "ADB", "Izmir": "ADB", "Dalaman": "DLM", "Bodrum": "BJV",
+    # Marruecos y Oriente Próximo
+    "Marrakech": "RAK", "Marrakesh": "RAK", "Fez": "FEZ", "Tánger": "TNG", "Tangier": "TNG",
+    "Agadir": "AGA", "Rabat": "RBA", "Nador": "NDR", "Ouarzazate": "OZZ", "Essaouira": "ESU",
+    "Tetuán": "TTU", "Tetouan": "TTU", "Ammán": "AMM", "Amman": "AMM", "Tel Aviv": "TLV",
+}
+
+_IATA_RE = re.compile(r"^[A-Za-z]{3}$")
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin tildes ('Málaga' -> 'malaga')."""
+    decomposed = unicodedata.normalize("NFKD", text.strip())
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+# Las claves se normalizan una sola vez al cargar el módulo: cada búsqueda solo
+# tiene que normalizar el texto de entrada y hacer una consulta O(1).
+CITY_TO_IATA = MappingProxyType({
+    sys.intern(_fold(city)): code for city, code in _RAW_CITY_TO_IATA.items()
+})
+
+
+def normalize_iata(city: str) -> "str | None":
+    """Devuelve el código IATA para una ciudad o código, o None si no se reconoce."""
+    code = CITY_TO_IATA.get(_fold(city))
+    if code is not None:
+        return code
+    if _IATA_RE.match(city.strip()):
+        return city.strip().upper()
+    return None
+
+
+def validate_date(s: str) -> bool:
+    """True si la fecha tiene formato YYYY-MM-DD y existe en el calendario."""
+    if not _DATE_RE.match(s.strip()):
+        return False
+    try:
+        datetime.strptime(s.strip(), "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+@tool
+def city_to_iata(city: str):
+    """
+    Devuelve el código IATA del aeropuerto principal de una ciudad (ej: Madrid -> MAD).
+    Útil para mostrar códigos de aeropuerto al usuario (ryanair_flight_search ya acepta ciudades).
+    """
+    code = normalize_iata(city)
+    if code is None:
+        return f"No conozco el aeropuerto de '{city}'."
+    return code
+
+# --- CACHÉ DE BÚSQUEDAS DE VUELOS ---
+# El LLM repite a menudo la misma búsqueda dentro de una conversación y la API de Render
+# es lenta (cold start). Guardamos los resultados buenos durante un rato.
+FLIGHT_CACHE_TTL = 600  # segundos (10 min)
+FLIGHT_CACHE_MAX_SIZE = 256
+
+# clave (origen, destino, fecha, moneda) -> (timestamp, resultado). Orden LRU.
+_FLIGHT_CACHE: "OrderedDict[tuple, tuple[float, object]]" = OrderedDict()
+# Búsquedas en curso: si llegan dos iguales a la vez, solo una va a la red y la otra
+# espera la misma tarea. Cada entrada se borra al terminar su búsqueda.
+_FLIGHT_INFLIGHT: "dict[tuple, asyncio.Task]" = {}
+
+
+def _flight_cache_get(key: tuple):
+    """Devuelve el resultado cacheado si sigue vigente, o None."""
+    entry = _FLIGHT_CACHE.get(key)
+    if entry is None:
+        return None
+    ts, value = entry
+    if time.monotonic() - ts >= FLIGHT_CACHE_TTL:
+        del _FLIGHT_CACHE[key]
+        return None
+    _FLIGHT_CACHE.move_to_end(key)
+    return value
+
+
+def _flight_cache_set(key: tuple, value) -> None:
+    _FLIGHT_CACHE[key] = (time.monotonic(), value)
+    _FLIGHT_CACHE.move_to_end(key)
+    while len(_FLIGHT_CACHE) > FLIGHT_CACHE_MAX_SIZE:
+        _FLIGHT_CACHE.popitem(last=False)
 
 @tool
 async def ryanair_flight_search(origen: str, destino: str, fecha: str, moneda: str = "EUR"):
     """
     Busca los vuelos más baratos en Ryanair de forma asíncrona.
     Args:
-        origen: Código IATA del aeropuerto de origen (ej: MAD, BCN).
-        destino: Código IATA del aeropuerto de destino (ej: LON, PAR).
+        origen: Ciudad o código IATA del aeropuerto de origen (ej: Madrid, MAD, BCN).
+        destino: Ciudad o código IATA del aeropuerto de destino (ej: Londres, STN, BVA).
         fecha: Fecha del vuelo en formato YYYY-MM-DD.
         moneda: Código de la moneda (default EUR).
     """
 
-    url = "https://ryanair-api-hx0t.onrender.com/api/search-fares"
+    codigo_origen = normalize_iata(origen)
+    codigo_destino = normalize_iata(destino)
+    if codigo_origen is None or codigo_destino is None:
+        desconocido = origen if codigo_origen is None else destino
+        return {"error": f"No reconozco '{desconocido}'. Usa el código IATA del aeropuerto (3 letras)."}
+    if not validate_date(fecha):
+        return {"error": f"Fecha inválida '{fecha}'. Usa el formato YYYY-MM-DD."}
+
+    key = (codigo_origen, codigo_destino, fecha.strip(), moneda.strip().upper())
+
+    cached = _flight_cache_get(key)
+    if cached is not None:
+        return cached
+
+    task = _FLIGHT_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_and_cache(key))
+        _FLIGHT_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _FLIGHT_INFLIGHT.pop(key, None))
+    # shield: si una de las peticiones se cancela, la búsqueda sigue para las demás
+    return await asyncio.shield(task)
+
+
+async def _fetch_and_cache(key: tuple):
+    result, cacheable = await _fetch_fares(*key)
+    # Solo cacheamos respuestas correctas, nunca los mensajes de error (429/502/HTTP)
+    if cacheable:
+        _flight_cache_set(key, result)
+    return result
+
+
+async def _fetch_fares(origen: str, destino: str, fecha: str, moneda: str):
+    """Llama a la API de vuelos. Devuelve (resultado, se_puede_cachear)."""
+    url = FLIGHT_API_BASE_URL + "api/search-fares"
     params = {
         "from": origen,
         "to": destino,
@@ -23,75 +279,191 @@ async def ryanair_flight_search(origen: str, destino: str, fecha: str, moneda: s
         "currency": moneda
     }
 
-    # Usamos un cliente asíncrono
-    # Aumentamos el timeout a 120 segundos porque la API de Render es lenta al despertar
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        try:
-            # await es la clave: libera al servidor mientras espera
-            response = await client.get(url, params=params)
-            
-            # Manejo específico del error 429 (Too Many Requests)
-            if response.status_code == 429:
-                return "⚠️ La API de vuelos está saturada momentáneamente. Por favor, espera 1 minuto e inténtalo de nuevo."
-
-            # Si es un error 502 (Bad Gateway), suele ser porque se está despertando
-            if response.status_code == 502:
-                return "⚠️ El servidor de vuelos se está reiniciando (Cold Start). Por favor, intenta la misma búsqueda en 30 segundos."
-
-            response.raise_for_status()
-            return response.json()
+    # Usamos el cliente asíncrono compartido (conexiones reutilizadas)
+    client = await get_http_client()
+    try:
+        # await es la clave: libera al servidor mientras espera
+        response = await client.get(url, params=params)
         
-        except httpx.HTTPStatusError as e:
-            return {"error": f"Error HTTP {e.response.status_code}: {str(e)}"}
-        except httpx.RequestError as e:
-            return {"error": f"Error de conexión: {str(e)}"}
-        except Exception as e:
-            return {"error": f"Error inesperado: {str(e)}"}
+        # Manejo específico del error 429 (Too Many Requests)
+        if response.status_code == 429:
+            return "⚠️ La API de vuelos está saturada momentáneamente. Por favor, espera 1 minuto e inténtalo de nuevo.", False
+
+        # Si es un error 502 (Bad Gateway), suele ser porque se está despertando
+        if response.status_code == 502:
+            return "⚠️ El servidor de vuelos se está reiniciando (Cold Start). Por favor, intenta la misma búsqueda en 30 segundos.", False
+
+        response.raise_for_status()
+        # orjson (en C) decodifica bastante más rápido que el json de la stdlib
+        return orjson.loads(response.content), True
     
-@tool
-def send_email(subject: str, body: str, destinatario: str):
-    """
-    Envía un correo electrónico con la información proporcionada.
-    Útil para enviar resúmenes de vuelos al usuario.
-    """
+    except httpx.HTTPStatusError as e:
+        return {"error": f"Error HTTP {e.response.status_code}: {str(e)}"}, False
+    except httpx.RequestError as e:
+        return {"error": f"Error de conexión: {str(e)}"}, False
+    except Exception as e:
+        return {"error": f"Error inesperado: {str(e)}"}, False
+    
+# --- ENVÍO DE EMAILS EN SEGUNDO PLANO ---
+# smtplib es bloqueante (connect + STARTTLS + login + sendmail son cientos de ms).
+# El tool solo encola el trabajo; una tarea en segundo plano lo consume y hace el SMTP
+# en un hilo con asyncio.to_thread, así el event loop nunca se bloquea.
+SMTP_TIMEOUT = 20          # segundos por operación SMTP (connect, login, sendmail...)
+EMAIL_DRAIN_TIMEOUT = 30   # segundos máximos para vaciar la cola al apagar
+
+_email_queue: "asyncio.Queue | None" = None
+# Email que el worker está enviando ahora mismo (para avisar si se queda sin enviar)
+_email_in_progress: "tuple | None" = None
+_email_worker_task: "asyncio.Task | None" = None
+
+# Conexión SMTP autenticada reutilizada entre envíos (ahorra TLS + AUTH).
+# Puede usarse desde varios hilos (worker de emails y envío directo sin worker, con
+# tool calls en paralelo), así que todo acceso a _smtp va protegido por _smtp_lock.
+_smtp: "smtplib.SMTP | None" = None
+_smtp_lock = threading.Lock()
+
+
+def _get_smtp(remitente: str, password: str) -> smtplib.SMTP:
+    """Devuelve una conexión SMTP viva, reconectando si el servidor la cerró."""
+    global _smtp
+    if _smtp is not None:
+        try:
+            if _smtp.noop()[0] == 250:
+                return _smtp
+        except smtplib.SMTPException:
+            pass
+        _close_smtp()
+
+    # Servidor y puerto SMTP de Gmail
+    # Con timeout: una conexión colgada no puede retener _smtp_lock indefinidamente
+    servidor = smtplib.SMTP('smtp.gmail.com', 587, timeout=SMTP_TIMEOUT)
+    # Iniciar la encriptación TLS (es crucial para Gmail)
+    servidor.starttls()
+    # Autenticación con tu correo y la Contraseña de Aplicación
+    servidor.login(remitente, password)
+    _smtp = servidor
+    return _smtp
+
+
+def _close_smtp() -> None:
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except Exception:
+            pass
+        _smtp = None
+
+
+def _send_email_sync(subject: str, body: str, destinatario: str) -> str:
+    """Envío SMTP bloqueante. Se ejecuta siempre fuera del event loop."""
     # --- CONFIGURACIÓN DE GMAIL ---
     REMITENTE = os.getenv("GMAIL_SENDER_EMAIL")  # Tu dirección de Gmail
     # ¡IMPORTANTE! Usa la Contraseña de Aplicación de 16 dígitos
     PASSWORD = os.getenv("GMAIL_APP_PASSWORD") 
-    DESTINATARIO = destinatario 
     if not REMITENTE or not PASSWORD:
         return "❌ Error de configuración: Credenciales de email no encontradas en el entorno."
-    # --- DATOS DEL MENSAJE ---
-    ASUNTO = subject
-    CUERPO = body
 
     # 1. Crear el objeto del mensaje
-    msg = MIMEText(CUERPO)
-    msg['Subject'] = ASUNTO
+    msg = MIMEText(body)
+    msg['Subject'] = subject
     msg['From'] = REMITENTE
-    msg['To'] = DESTINATARIO
+    msg['To'] = destinatario
+
+    # 2. Enviar reutilizando la conexión (un reintento si se había caído)
+    with _smtp_lock:
+        for intento in range(2):
+            try:
+                servidor = _get_smtp(REMITENTE, PASSWORD)
+                servidor.sendmail(REMITENTE, destinatario, msg.as_string())
+                print("✅ Correo enviado exitosamente usando Gmail y Python.")
+                return f"✅ Correo enviado a {destinatario}."
+            except smtplib.SMTPServerDisconnected:
+                _close_smtp()
+                if intento == 1:
+                    print("❌ Error al enviar el correo: conexión SMTP cerrada")
+                    return "❌ Error al enviar el correo: conexión SMTP cerrada."
+            except Exception as e:
+                _close_smtp()
+                print(f"❌ Error al enviar el correo: {e}")
+                return f"❌ Error al enviar el correo: {e}"
+
+
+def _shutdown_smtp() -> None:
+    with _smtp_lock:
+        _close_smtp()
 
-    # 2. Establecer la conexión y enviar
-    servidor = None
+
+async def _email_worker(queue: asyncio.Queue) -> None:
+    """Consume la cola de emails hasta recibir None."""
+    global _email_in_progress
+    while True:
+        job = await queue.get()
+        try:
+            if job is None:
+                return
+            _email_in_progress = job
+            await asyncio.to_thread(_send_email_sync, *job)
+        except Exception as e:
+            print(f"❌ Error en el worker de emails: {e}")
+        finally:
+            _email_in_progress = None
+            queue.task_done()
+
+
+def start_email_worker() -> asyncio.Task:
+    """Arranca la tarea que envía los emails encolados (se llama en el lifespan)."""
+    global _email_queue, _email_worker_task
+    _email_queue = asyncio.Queue()
+    _email_worker_task = asyncio.create_task(_email_worker(_email_queue))
+    return _email_worker_task
+
+
+async def stop_email_worker() -> None:
+    """Envía los emails pendientes, para el worker y cierra la conexión SMTP."""
+    global _email_queue, _email_worker_task
+    if _email_worker_task is not None:
+        await _email_queue.put(None)
+        try:
+            # shield: si se agota el tiempo cancelamos nosotros el worker, no wait_for
+            await asyncio.wait_for(asyncio.shield(_email_worker_task), EMAIL_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            _email_worker_task.cancel()
+            if _email_in_progress:
+                # Su hilo SMTP sigue en marcha (acaba como mucho con SMTP_TIMEOUT): no sabemos si llegará
+                subject, _, destinatario = _email_in_progress
+                print(f"⚠️ Correo quizá sin enviar al apagar: '{subject}' para {destinatario}")
+            pendientes = []
+            while not _email_queue.empty():
+                job = _email_queue.get_nowait()
+                if job is not None:
+                    pendientes.append(job)
+            for subject, _, destinatario in pendientes:
+                print(f"❌ Correo sin enviar al apagar: '{subject}' para {destinatario}")
+    _email_queue = None
+    _email_worker_task = None
     try:
-        # Servidor y puerto SMTP de Gmail
-        servidor = smtplib.SMTP('smtp.gmail.com', 587)
-        
-        # Iniciar la encriptación TLS (es crucial para Gmail)
-        servidor.starttls() 
-        
-        # Autenticación con tu correo y la Contraseña de Aplicación
-        servidor.login(REMITENTE, PASSWORD)
-        
-        # Enviar el correo
-        servidor.sendmail(REMITENTE, DESTINATARIO, msg.as_string())
-        
-        print("✅ Correo enviado exitosamente usando Gmail y Python.")
+        await asyncio.wait_for(asyncio.to_thread(_shutdown_smtp), SMTP_TIMEOUT)
+    except asyncio.TimeoutError:
+        print("⚠️ No se pudo cerrar la conexión SMTP a tiempo")
 
-    except Exception as e:
-        print(f"❌ Error al enviar el correo: {e}")
 
-    finally:
-        # Cerrar la conexión
-        if 'servidor':
-            servidor.quit()
\ No newline at end of file
+@tool
+async def send_email(subject: str, body: str, destinatario: str):
+    """
+    Envía un correo electrónico con la información proporcionada.
+    Útil para enviar resúmenes de vuelos al usuario.
+    """
+    if not os.getenv("GMAIL_SENDER_EMAIL") or not os.getenv("GMAIL_APP_PASSWORD"):
+        return "❌ Error de configuración: Credenciales de email no encontradas en el entorno."
+
+    # Sin worker arrancado (p.ej. usando el agente fuera de la API) enviamos en un hilo
+    if _email_worker_task is None or _email_worker_task.done():
+        return await asyncio.to_thread(_send_email_sync, subject, body, destinatario)
+
+    await _email_queue.put((subject, body, destinatario))
+    # El envío real ocurre después: el resultado no puede confirmar la entrega
+    return (
+        f"📨 Correo para {destinatario} en cola de envío (aún NO entregado). "
+        "Di al usuario que se enviará en breve, no que ya se ha enviado."
+    )
@@ -1,13 +1,52 @@
 import os
+import asyncio
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+import orjson
 
 # Importamos tu clase del archivo agent.py
 from agent import FlightAssistant
+from flightassistant_tools import get_http_client, warmup_http_client, close_http_client, start_email_worker, stop_email_worker
+
+# --- 0. AJUSTES DE SQLITE ---
+# AsyncSqliteSaver.setup() ya activa journal_mode=WAL (los lectores no se bloquean
+# mientras se escribe). Aquí añadimos el resto: con synchronous=NORMAL se hacen muchos
+# menos fsync por checkpoint.
+SQLITE_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=268435456;",  # 256 MB
+    "PRAGMA busy_timeout=5000;",    # ms
+]
+
+# Cada cuánto truncamos el WAL para que no crezca sin límite en el disco de Render
+WAL_CHECKPOINT_INTERVAL = 300  # segundos
+
+
+async def configure_sqlite(checkpointer):
+    """Aplica los PRAGMA de rendimiento sobre la conexión aiosqlite del checkpointer."""
+    async with checkpointer.lock:
+        for pragma in SQLITE_PRAGMAS:
+            async with checkpointer.conn.execute(pragma):
+                pass
+        await checkpointer.conn.commit()
+
+
+async def wal_checkpoint_loop(checkpointer):
+    """Tarea en segundo plano: vuelca y trunca el WAL periódicamente."""
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            # Con el lock del saver: así no se cuela entre un INSERT y su COMMIT
+            async with checkpointer.lock, checkpointer.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);"):
+                pass
+        except Exception as e:
+            print(f"⚠️ Error en wal_checkpoint: {e}")
 
 # --- 1. GESTIÓN DEL CICLO DE VIDA (LIFESPAN) ---
 # Esto se ejecuta una sola vez al arrancar el servidor.
@@ -15,23 +54,68 @@ from agent import FlightAssistant
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("🚀 Iniciando servidor y conectando a memoria...")
+
+    # Cliente HTTP compartido por las herramientas (singleton de flightassistant_tools,
+    # keep-alive entre búsquedas). Se cierra al apagar con close_http_client().
+    await get_http_client()
+    # Precalentamos DNS + TLS con la API de vuelos en segundo plano mientras arrancamos
+    warmup_tasks = [asyncio.create_task(warmup_http_client())]
+
+    # Worker en segundo plano para los emails (el SMTP no bloquea el event loop)
+    start_email_worker()
     
     # NOTA PARA RENDER: 
     # En la versión gratuita/web services de Render, el sistema de archivos es efímero.
     # 'memory.db' se borrará cada vez que redespliegues. 
     # Para producción real, en el futuro cambiaremos esto por Postgres.
     async with AsyncSqliteSaver.from_conn_string("memory.db") as checkpointer:
+        # Ajustamos los PRAGMA antes de crear las tablas del checkpointer
+        await configure_sqlite(checkpointer)
+        wal_task = asyncio.create_task(wal_checkpoint_loop(checkpointer))
+
         # Inicializamos el agente
         assistant = FlightAssistant(memory=checkpointer)
         await assistant.setup()
+        warmup_tasks.append(asyncio.create_task(assistant.warmup()))
         
         # Guardamos la instancia del agente en la app para usarla en los endpoints
         app.state.agent = assistant
+
+        # Un lock por thread_id: dos turnos del mismo hilo no intercalan sus checkpoints,
+        # pero hilos distintos siguen ejecutándose en paralelo. El propio AsyncSqliteSaver
+        # ya serializa sus escrituras sobre la conexión con su lock interno.
+        # thread_id -> [lock, nº de peticiones que lo usan o esperan]; ver thread_lock()
+        app.state.thread_locks = {}
         
         print("✅ Agente listo y esperando peticiones.")
         yield
+
+        # Paramos las tareas en segundo plano antes de cerrar la conexión
+        for task in warmup_tasks:
+            task.cancel()
+        wal_task.cancel()
+        try:
+            await wal_task
+        except asyncio.CancelledError:
+            pass
         
     print("🛑 Apagando servidor y cerrando conexiones...")
+    await stop_email_worker()
+    await close_http_client()
+
+@asynccontextmanager
+async def thread_lock(thread_id: str):
+    """Lock del hilo; se borra en cuanto nadie lo usa ni lo espera (el thread_id lo elige el cliente)."""
+    locks = app.state.thread_locks
+    entry = locks.setdefault(thread_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del locks[thread_id]
 
 # --- 2. CONFIGURACIÓN DE LA APP ---
 app = FastAPI(
@@ -44,10 +128,12 @@ app = FastAPI(
 # Permite que tu frontend (que estará en otro dominio) hable con este backend.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["https://frontend-flightassistant.onrender.com/"],  # En producción, cambia "*" por la URL de tu frontend en Render
+    # Sin barra final: el navegador envía el Origin sin ella y CORS exige coincidencia exacta
+    allow_origins=["https://frontend-flightassistant.onrender.com"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,  # El navegador cachea el preflight (OPTIONS) durante un día
 )
 
 # --- 4. MODELOS DE DATOS (Pydantic) ---
@@ -76,10 +162,11 @@ async def chat_endpoint(request: ChatRequest):
     
     try:
         # Ejecutamos el agente pasando el mensaje y el ID de hilo
-        respuesta_texto = await agent.run_superstep(
-            user_input=request.message, 
-            thread_id=request.thread_id
-        )
+        async with thread_lock(request.thread_id):
+            respuesta_texto = await agent.run_superstep(
+                user_input=request.message, 
+                thread_id=request.thread_id
+            )
         
         return ChatResponse(response=str(respuesta_texto))
     
@@ -87,6 +174,37 @@ async def chat_endpoint(request: ChatRequest):
         print(f"❌ Error procesando solicitud: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(event: str, data) -> bytes:
+    """Formatea un evento Server-Sent Events (los datos van en JSON para admitir saltos de línea)."""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Igual que /chat pero envía la respuesta token a token por SSE (text/event-stream).
+    Eventos: 'reset' (descartar texto parcial), 'token', 'done' (respuesta final) y 'error'.
+    """
+    agent: FlightAssistant = app.state.agent
+
+    async def event_generator():
+        # El lock del hilo se mantiene mientras dure el stream
+        async with thread_lock(request.thread_id):
+            try:
+                async for event, data in agent.stream_superstep(
+                    user_input=request.message,
+                    thread_id=request.thread_id
+                ):
+                    yield sse_event(event, data)
+            except Exception as e:
+                print(f"❌ Error procesando solicitud (stream): {e}")
+                yield sse_event("error", str(e))
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- 6. ARRANQUE DEL SERVIDOR (PARA RENDER) ---
 if __name__ == "__main__":
     # Render inyecta la variable de entorno PORT. 